@@ -18,7 +18,7 @@
 
 """Setup script."""
 
-from distutils.core import setup
+from distutils.core import setup, Extension
 
 setup(name="upf-service-agent",
       version="1.0",
@@ -26,4 +26,8 @@ setup(name="upf-service-agent",
       author="Giovanni Baggio",
       author_email="g.baggio@fbk.eu",
       url="https://lightedge.io/",
-      packages=['upfserviceagent'], requires=['python-iptables'])
+      packages=['upfserviceagent'],
+      ext_modules=[Extension('upfserviceagent._uemap_parser',
+                             ['upfserviceagent/_uemap_parser.c'],
+                             optional=True)],
+      requires=['python-iptables', 'websockets(>=14.0)'])
@@ -0,0 +1,192 @@
+/*
+ * Copyright (c) 2020 Fondazione Bruno Kessler
+ * Author(s): Giovanni Baggio (g.baggio@fbk.eu)
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied. See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+/* UPF Service Agent UEmap parser. */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <string.h>
+
+#define UEMAP_FIELDS 5
+
+/*
+ * Build an entry_type tuple from the comma separated fields of a line.
+ * Return 1 and set *entry on success, 0 if the line does not have
+ * UEMAP_FIELDS fields and -1 on error.
+ */
+static int
+parse_line(PyTypeObject *entry_type, const char *field, const char *end,
+           PyObject **entry)
+{
+    PyObject *row, *args;
+    const char *pos;
+    Py_ssize_t i = 0, commas = 0;
+
+    for (pos = field; (pos = memchr(pos, ',', end - pos)) != NULL; pos++)
+        commas++;
+
+    if (commas != UEMAP_FIELDS - 1)
+        return 0;
+
+    row = PyTuple_New(UEMAP_FIELDS);
+    if (row == NULL)
+        return -1;
+
+    for (;;) {
+        const char *comma = memchr(field, ',', end - field);
+        const char *stop = comma ? comma : end;
+        PyObject *value;
+
+        value = PyUnicode_DecodeUTF8(field, stop - field, NULL);
+        if (value == NULL) {
+            Py_DECREF(row);
+            return -1;
+        }
+
+        /* UE addresses repeat across polls and are used as keys */
+        if (i == 0)
+            PyUnicode_InternInPlace(&value);
+
+        PyTuple_SET_ITEM(row, i++, value);
+
+        if (comma == NULL)
+            break;
+
+        field = comma + 1;
+    }
+
+    /* tuple.__new__(entry_type, row), as UEEntry._make(row) does */
+    args = PyTuple_Pack(1, row);
+    Py_DECREF(row);
+
+    if (args == NULL)
+        return -1;
+
+    *entry = PyTuple_Type.tp_new(entry_type, args, NULL);
+    Py_DECREF(args);
+
+    return *entry == NULL ? -1 : 1;
+}
+
+PyDoc_STRVAR(parse_doc,
+"parse(response, entry_type)\n"
+"\n"
+"Return the uemap reply as a dict of entry_type tuples by ue_ip, and the\n"
+"list of the lines skipped as they do not have one field per entry_type\n"
+"field.");
+
+static PyObject *
+parse(PyObject *Py_UNUSED(self), PyObject *args)
+{
+    PyTypeObject *entry_type;
+    PyObject *uemap, *malformed, *result;
+    const char *pos, *end;
+    Py_ssize_t length;
+
+    if (!PyArg_ParseTuple(args, "s#O!:parse", &pos, &length,
+                          &PyType_Type, &entry_type))
+        return NULL;
+
+    if (!PyType_IsSubtype(entry_type, &PyTuple_Type)) {
+        PyErr_SetString(PyExc_TypeError, "entry_type must be a tuple type");
+        return NULL;
+    }
+
+    uemap = PyDict_New();
+    if (uemap == NULL)
+        return NULL;
+
+    malformed = PyList_New(0);
+    if (malformed == NULL)
+        goto error;
+
+    end = pos + length;
+
+    while (pos < end) {
+        const char *eol = memchr(pos, '\n', end - pos);
+        const char *stop = eol ? eol : end;
+        PyObject *entry;
+        int err;
+
+        /* as str.rstrip('\r') in the Python parser */
+        while (stop > pos && stop[-1] == '\r')
+            stop--;
+
+        if (stop > pos) {
+
+            switch (parse_line(entry_type, pos, stop, &entry)) {
+            case 1:
+                err = PyDict_SetItem(uemap, PyTuple_GET_ITEM(entry, 0),
+                                     entry);
+                Py_DECREF(entry);
+                break;
+            case 0:
+                entry = PyUnicode_DecodeUTF8(pos, stop - pos, "replace");
+                if (entry == NULL)
+                    goto error;
+                err = PyList_Append(malformed, entry);
+                Py_DECREF(entry);
+                break;
+            default:
+                goto error;
+            }
+
+            if (err < 0)
+                goto error;
+        }
+
+        if (eol == NULL)
+            break;
+
+        pos = eol + 1;
+    }
+
+    result = PyTuple_Pack(2, uemap, malformed);
+    Py_DECREF(uemap);
+    Py_DECREF(malformed);
+
+    return result;
+
+error:
+    Py_DECREF(uemap);
+    Py_XDECREF(malformed);
+    return NULL;
+}
+
+static PyMethodDef uemap_parser_methods[] = {
+    {"parse", parse, METH_VARARGS, parse_doc},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef uemap_parser_module = {
+    PyModuleDef_HEAD_INIT,
+    "_uemap_parser",
+    "UPF Service Agent UEmap parser.",
+    -1,
+    uemap_parser_methods,
+    NULL,
+    NULL,
+    NULL,
+    NULL
+};
+
+PyMODINIT_FUNC
+PyInit__uemap_parser(void)
+{
+    return PyModule_Create(&uemap_parser_module);
+}
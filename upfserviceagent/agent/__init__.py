@@ -23,6 +23,7 @@ PT_VERSION = 0
 # agent to manager
 PT_HELLO = "hello"
 PT_UE_MAP = "ue_map"
+PT_UE_MAP_DIFF = "ue_map_diff"
 PT_MATCH_ACTION_RESULT = "match_action_result"
 
 # manager to agent
@@ -18,83 +18,136 @@
 
 """The UPF Service Agent."""
 
-import time
+import asyncio
 import logging
+import random
+import signal
 import sys
 import json
 
 from argparse import ArgumentParser
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from functools import partial
+from secrets import token_hex
 
-import websocket
-from threading import Thread
-from uuid import uuid4
+import websockets
 
 from upfserviceagent.agent import PT_VERSION
 from upfserviceagent.agent import PT_HELLO
 from upfserviceagent.agent import PT_UE_MAP
+from upfserviceagent.agent import PT_UE_MAP_DIFF
 from upfserviceagent.agent import PT_MATCH_ACTION_RESULT
+from upfserviceagent.agent import PT_MATCH_ADD
+from upfserviceagent.agent import PT_MATCH_DELETE
 from upfserviceagent.handlers.uemap import get_uemap
+from upfserviceagent.handlers.matchmap import Match
 from upfserviceagent.handlers.matchmap import MatchMap
 
 
+def _asdict(obj):
+    """Serialize named tuples and mappings, e.g. UE maps, as JSON objects."""
+
+    if hasattr(obj, "_asdict"):
+        return obj._asdict()
+
+    if isinstance(obj, Mapping):
+        return dict(obj)
+
+    raise TypeError("Type is not JSON serializable: %s" % type(obj).__name__)
+
+
+def _plain(obj):
+    """Replace named tuples and mappings with dicts, json cannot emit them."""
+
+    if isinstance(obj, Mapping):
+        return {k: _plain(v) for k, v in obj.items()}
+
+    if hasattr(obj, "_asdict"):
+        return obj._asdict()
+
+    return obj
+
+
+try:
+    import orjson
+
+    json_loads = orjson.loads
+
+    def json_dumps(obj):
+        return orjson.dumps(obj, default=_asdict)
+
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        return json.dumps(_plain(obj)).encode()
+
+
+logger = logging.getLogger(__name__)
+
 UPF_SERVICE_MANAGER_ADDRESS = "127.0.0.1"
 UPF_SERVICE_MANAGER_PORT = 7000
 UPF_SERVICE_MANAGER_EVERY = 5
 UPF_SERVICE_MANAGER_TAG = None
+UPF_SERVICE_MANAGER_MAX_BACKOFF = 60
 UPF_SERVICE_ADDRESS = "127.0.0.1"
 UPF_SERVICE_PORT = 7777
 UPF_SERVICE_ELEMENT = "upfr"
 UPF_SERVICE_UE_SUBNET = "10.0.0.0/8"
 UPF_SERVICE_EVERY = 2
+UPF_SERVICE_RESYNC_EVERY = 30
+UPF_SERVICE_MATCH_QUEUE = 1024
 
 
 def get_uuid():
-    return str(uuid4())
-
+    return token_hex(16)
 
-def dump_message(message):
-    """Dump a generic message.
 
-    Args:
-        message, a message
+@lru_cache(maxsize=None)
+def get_header(message_type):
+    """Return the serialized fixed header fields, up to the uuid value."""
 
-    Returns:
-        None
-    """
+    return b'{"version":%s,"type":%s,"uuid":' % (json_dumps(PT_VERSION),
+                                                 json_dumps(message_type))
 
-    header = "Received %s, uuid %s" % (message['type'], message['uuid'])
 
-    del message['version']
-    del message['type']
+def encode_message(message_type, message, uuid):
+    """Serialize a message, splicing the fixed header fields in front.
 
-    fields = ["%s=%s" % (k, v)for k, v in message.items()]
-    logging.info("%s (%s)", header, ", ".join(fields))
+    The message itself is serialized as is and never modified.
+    """
 
+    header = get_header(message_type) + json_dumps(uuid)
+    payload = json_dumps(message)
 
-def on_open(websock):
-    """ Called when the web-socket is opened. """
+    if payload == b"{}":
+        return header + b"}"
 
-    logging.info("Socket %s opened...", websock.url)
+    return header + b"," + payload[1:]
 
 
-def on_message(websock, message):
-    """ Called on receiving a new message. """
+def dump_message(message):
+    """Dump a generic message.
 
-    try:
-        msg = json.loads(message)
-        websock.handle_message(msg)
-    except ValueError as ex:
-        logging.info("Invalid input: %s", ex)
-        logging.info(message)
+    Args:
+        message, a message
 
+    Returns:
+        None
+    """
 
-def on_close(websock):
-    """ Called when the web-socket is closed. """
+    if not logger.isEnabledFor(logging.INFO):
+        return
 
-    logging.info("Socket %s closed...", websock.url)
+    fields = ["%s=%s" % (k, v) for k, v in message.items()
+              if k not in ('version', 'type')]
+    logger.info("Received %s, uuid %s (%s)", message['type'],
+                message['uuid'], ", ".join(fields))
 
 
-class UPFServiceAgent(websocket.WebSocketApp):
+class UPFServiceAgent:
     """The UPF Service Agent.
 
     # us = UPF Service
@@ -103,21 +156,25 @@ class UPFServiceAgent(websocket.WebSocketApp):
     Attributes:
         usm_addr: The UPF Service Manager address
         usm_port: The UPF Service Manager port
-        usm_every: The hello period toward the UPF Service Manager
+        usm_every: The keepalive period toward the UPF Service Manager
         usm_tag: The tag to use in hello messages toward the UPF Service Manager
         us_addr: The UPF Service address
         us_port: The UPF Service port
         us_element: The UPF Service click element name
         us_ue_subnet: The UE subnet to be considered by the UPF Service
         us_every: The UPF Service UE list's polling period
+
+    The UE map is sent in full on connection and then every
+    UPF_SERVICE_RESYNC_EVERY polls; in between only the entries which were
+    added/changed or removed since the last poll are sent.
     """
 
     def __init__(self, url, usm_addr, usm_port, usm_every, usm_tag, us_addr,
                  us_port, us_element, us_ue_subnet, us_every, logdir):
 
-        super().__init__(url)
-
-        self._stop = False
+        self.url = url
+        self.ws = None
+        self._stop_evt = asyncio.Event()
         self.usm_addr = usm_addr
         self.usm_port = usm_port
         self.usm_every = usm_every
@@ -127,109 +184,228 @@ class UPFServiceAgent(websocket.WebSocketApp):
         self.us_element = us_element
         self.us_ue_subnet = us_ue_subnet
         self.us_every = us_every
-        self.on_open = None
-        self.on_close = None
-        self.on_message = None
         self.logdir = logdir
-        self.matchmap = None
+
+        self._last_uemap = dict()
+        self._polls = 0
+
+        # click is accessed by a single worker thread, so that match
+        # operations run in the order they are received
+        self._click_exec = ThreadPoolExecutor(max_workers=1,
+                                              thread_name_prefix='click')
+        self._match_q = None
+
+        self._dispatch = {PT_MATCH_ADD: self._handle_match_add,
+                          PT_MATCH_DELETE: self._handle_match_delete}
+
+        # the hello payload never changes, only its uuid does
+        hello = {'every': self.usm_every, 'tag': self.usm_tag}
+        self._hello_head = get_header(PT_HELLO) + b'"'
+        self._hello_tail = b'",' + json_dumps(hello)[1:]
 
         self.click_config = {"host": self.us_addr,
                              "port": self.us_port,
                              "element": self.us_element}
 
-        logging.info("Initializing the UPF Service Agent...")
+        self.matchmap = MatchMap(self.us_ue_subnet, **self.click_config)
+
+    @property
+    def stopped(self):
+        """ True once stop() has been called. """
 
-        self._init_upf_service()
-        self._init_periodic_tasks()
+        return self._stop_evt.is_set()
 
     def stop(self):
-        """ Stop the threads. """
+        """ Stop the tasks, close the web-socket and the UPF Service handlers.
 
-        self._stop = True
+        Must be called from the event loop thread while the agent is running.
+        """
+
+        self._stop_evt.set()
         self.matchmap.stop()
+        self._click_exec.shutdown(wait=False, cancel_futures=True)
 
-    def _init_upf_service(self):
-        """Init matchmap handler, block until the UPF Service is available. """
+        if self.ws:
+            asyncio.ensure_future(self.ws.close())
 
-        self.matchmap = MatchMap(self.us_ue_subnet, **self.click_config)
-        self.matchmap.start()
+    async def wait_stop(self, timeout):
+        """ Wait up to timeout seconds for stop(), return True if stopped. """
+
+        try:
+            await asyncio.wait_for(self._stop_evt.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+
+        return True
 
-    def _init_periodic_tasks(self):
-        """Init threads. """
+    async def start(self):
+        """Init matchmap handler, wait until the UPF Service is available. """
 
-        hello_sender = Thread(target=self._send_periodic_hello)
-        hello_sender.start()
-        uemap_poller = Thread(target=self._uemap_poller)
-        uemap_poller.start()
+        logger.info("Initializing the UPF Service Agent...")
 
-    def _send_periodic_hello(self):
-        """Hello sender thread handler. """
+        await self.matchmap.start(self._click_exec)
 
-        while not self._stop:
+    async def run(self, websock):
+        """Run the periodic tasks and the receiver over an open web-socket. """
+
+        self.ws = websock
+        self._last_uemap = dict()
+        self._polls = 0
+        self._match_q = asyncio.Queue(maxsize=UPF_SERVICE_MATCH_QUEUE)
+        logger.info("Socket %s opened...", self.url)
+
+        # keepalives are websocket pings, hello is only sent once
+        await self.send_hello()
+
+        tasks = [asyncio.create_task(self._poll_loop()),
+                 asyncio.create_task(self._match_worker()),
+                 asyncio.create_task(self._recv_loop())]
+
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.ws = None
+            logger.info("Socket %s closed...", self.url)
+
+    async def _poll_loop(self):
+        """UEMap poller task. """
+
+        loop = asyncio.get_running_loop()
+
+        while not self.stopped:
 
             try:
-                self.send_hello()
+                uemap = await loop.run_in_executor(
+                    self._click_exec, partial(get_uemap, **self.click_config))
+                await self.send_ue_map_update(uemap)
             except Exception as ex:
-                logging.info("Cannot send hello")
-            finally:
-                time.sleep(self.usm_every)
+                logger.info("Cannot send ue map updates")
+
+            await self.wait_stop(self.us_every)
 
-    def _uemap_poller(self):
-        """UEMap poller thread handler. """
+    async def _recv_loop(self):
+        """Receiver task, runs until the web-socket is closed. """
 
-        while not self._stop:
+        while True:
+
+            # text frames are kept as bytes, the json decoder takes them as is
+            message = await self.ws.recv(decode=False)
 
             try:
-                uemap = get_uemap(**self.click_config)
-                self.send_ue_map(uemap)
+                msg = json_loads(message)
+            except ValueError as ex:
+                logger.info("Invalid input: %s", ex)
+                logger.info(message)
+                continue
+
+            # the handlers, and the queue when full, index messages by key
+            if not isinstance(msg, dict):
+                logger.info("Invalid input, not a JSON object: %s", message)
+                continue
+
+            # do not hold the receiver while click is busy
+            await self._enqueue(msg)
+
+    async def _enqueue(self, msg):
+        """Queue a message for the worker, dropping the oldest if full. """
+
+        try:
+            self._match_q.put_nowait(msg)
+            return
+        except asyncio.QueueFull:
+            dropped = self._match_q.get_nowait()
+            self._match_q.put_nowait(msg)
+
+        logger.info("Message queue full, dropping %s, uuid %s",
+                    dropped.get('type'), dropped.get('uuid'))
+
+        if dropped.get('type') in self._dispatch and 'uuid' in dropped:
+            await self.send_match_action_result(500, dropped['uuid'],
+                                                reason="Message queue full")
+
+    async def _match_worker(self):
+        """Worker task, handles the queued messages in order. """
+
+        while True:
+
+            msg = await self._match_q.get()
+
+            try:
+                await self.handle_message(msg)
             except Exception as ex:
-                logging.info("Cannot send ue map updates")
-            finally:
-                time.sleep(self.us_every)
+                logger.info("Cannot handle %s message: %s",
+                            msg.get('type'), ex)
 
-    def send_message(self, message_type, message, uuid):
+    async def send_message(self, message_type, message, uuid):
         """Add fixed header fields and send message. """
 
-        message['version'] = PT_VERSION
-        message['type'] = message_type
-        message['uuid'] = uuid
+        msg = encode_message(message_type, message, uuid)
+        await self.send_encoded(message_type, uuid, msg)
+
+    async def send_encoded(self, message_type, uuid, msg):
+        """Send an already serialized message. """
 
-        logging.info("Sending %s, uuid %s", message['type'], message['uuid'])
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Sending %s, uuid %s", message_type, uuid)
 
-        msg = json.dumps(message)
-        self.send(msg)
+        await self.ws.send(msg, text=True)
 
-    def send_hello(self):
+    async def send_hello(self):
         """ Send HELLO message. """
 
-        hello = {'every': self.usm_every, 'tag': self.usm_tag}
-        self.send_message(PT_HELLO, hello, get_uuid())
+        uuid = get_uuid()
+        msg = self._hello_head + uuid.encode() + self._hello_tail
+        await self.send_encoded(PT_HELLO, uuid, msg)
 
-    def send_ue_map(self, ue_map):
+    async def send_ue_map(self, ue_map):
         """ Send UE_MAP message. """
 
-        self.send_message(PT_UE_MAP, ue_map, get_uuid())
+        await self.send_message(PT_UE_MAP, ue_map, get_uuid())
+
+    async def send_ue_map_diff(self, added, removed):
+        """ Send UE_MAP_DIFF message. """
+
+        diff = {'added': added,
+                'removed': removed}
+        await self.send_message(PT_UE_MAP_DIFF, diff, get_uuid())
+
+    async def send_ue_map_update(self, ue_map):
+        """ Send either the full UE map or the changes since the last one. """
+
+        if self._polls % UPF_SERVICE_RESYNC_EVERY == 0:
+            await self.send_ue_map(ue_map)
+        elif ue_map is not self._last_uemap:
+            # get_uemap() returns the same mapping until the UE map changes
+            last = self._last_uemap
+            added = {k: v for k, v in ue_map.items() if last.get(k) != v}
+            removed = [k for k in last if k not in ue_map]
+            if added or removed:
+                await self.send_ue_map_diff(added, removed)
+
+        self._last_uemap = ue_map
+        self._polls += 1
 
-    def send_match_action_result(self, status, uuid, reason=None):
+    async def send_match_action_result(self, status, uuid, reason=None):
         """ Send MATCH_ACTION_RESULT message. """
 
-        result = {'status': status,
-                  'reason': reason}
-        self.send_message(PT_MATCH_ACTION_RESULT, result, uuid)
+        msg = (get_header(PT_MATCH_ACTION_RESULT) + json_dumps(uuid) +
+               b',"status":%d,"reason":%s}' % (status, json_dumps(reason)))
+        await self.send_encoded(PT_MATCH_ACTION_RESULT, uuid, msg)
 
-    def handle_message(self, msg):
+    async def handle_message(self, msg):
         """ Handle incoming message (as a Python dict). """
 
-        handler_name = "_handle_%s" % msg['type']
+        handler = self._dispatch.get(msg['type'])
 
-        if not hasattr(self, handler_name):
-            logging.info("Unknown message type: %s", msg['type'])
+        if not handler:
+            logger.info("Unknown message type: %s", msg['type'])
             return
 
-        handler = getattr(self, handler_name)
-        handler(msg)
+        await handler(msg)
 
-    def _handle_match_add(self, message):
+    async def _handle_match_add(self, message):
         """Handle MATCH_ADD message.
 
         Args:
@@ -243,8 +419,13 @@ class UPFServiceAgent(websocket.WebSocketApp):
         status = 201
         reason = None
 
+        loop = asyncio.get_running_loop()
+
         try:
-            self.matchmap.add_matchmap(message["match"], message["uuid"])
+            match = Match.from_dict(message["match"])
+            await loop.run_in_executor(self._click_exec,
+                                       self.matchmap.add_matchmap,
+                                       match, message["uuid"])
 
         except KeyError as ex:
             status = 404
@@ -258,13 +439,13 @@ class UPFServiceAgent(websocket.WebSocketApp):
         finally:
 
             if status == 201:
-                self.send_match_action_result(status, message["uuid"])
+                await self.send_match_action_result(status, message["uuid"])
             else:
-                logging.info("Exception while adding matchmap: %s" % reason)
-                self.send_match_action_result(500, message["uuid"],
-                                              reason=reason)
+                logger.info("Exception while adding matchmap: %s", reason)
+                await self.send_match_action_result(500, message["uuid"],
+                                                    reason=reason)
 
-    def _handle_match_delete(self, message):
+    async def _handle_match_delete(self, message):
         """Handle MATCH_DELETE message.
 
         Args:
@@ -278,8 +459,12 @@ class UPFServiceAgent(websocket.WebSocketApp):
         status = 204
         reason = None
 
+        loop = asyncio.get_running_loop()
+
         try:
-            self.matchmap.delete_matchmap(message["match_uuid"])
+            await loop.run_in_executor(self._click_exec,
+                                       self.matchmap.delete_matchmap,
+                                       message["match_uuid"])
 
         except KeyError as ex:
             status = 404
@@ -290,11 +475,47 @@ class UPFServiceAgent(websocket.WebSocketApp):
         finally:
 
             if status == 204:
-                self.send_match_action_result(status, message["uuid"])
+                await self.send_match_action_result(status, message["uuid"])
             else:
-                logging.info("Exception while deleting matchmap: %s" % reason)
-                self.send_match_action_result(500, message["uuid"],
-                                              reason=reason)
+                logger.info("Exception while deleting matchmap: %s", reason)
+                await self.send_match_action_result(500, message["uuid"],
+                                                    reason=reason)
+
+
+async def connect(agent):
+    """Start the agent, then connect to the manager and run it, reconnecting
+    on failure.
+
+    Reconnections back off exponentially, with jitter, up to
+    UPF_SERVICE_MANAGER_MAX_BACKOFF seconds.
+    """
+
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, agent.stop)
+
+    await agent.start()
+
+    backoff = 0
+
+    while not agent.stopped:
+        try:
+            logger.info("Trying to connect to manager %s", agent.url)
+            async with websockets.connect(
+                    agent.url, ping_interval=agent.usm_every) as websock:
+                backoff = 0
+                await agent.run(websock)
+        except (OSError, websockets.WebSocketException) as ex:
+            logger.info("Connection error: %s", ex)
+
+        if agent.stopped:
+            break
+
+        backoff = min(UPF_SERVICE_MANAGER_MAX_BACKOFF,
+                      backoff * 2 if backoff else 1)
+        delay = backoff + random.uniform(0, backoff * 0.1)
+
+        logger.info("Unable to connect, retrying in %.1fs", delay)
+        await agent.wait_stop(delay)
 
 
 def main():
@@ -313,11 +534,13 @@ def main():
                              % UPF_SERVICE_MANAGER_ADDRESS)
 
     parser.add_argument("-mp", "--usm_port", dest="usm_port",
+                        type=int,
                         default=UPF_SERVICE_MANAGER_PORT,
                         help="UPF Service Manager port; default=%s"
                              % UPF_SERVICE_MANAGER_PORT)
 
     parser.add_argument("-me", "--usm_every", dest="usm_every",
+                        type=int,
                         default=UPF_SERVICE_MANAGER_EVERY,
                         help="UPF Service Manager keepalive period; default=%s"
                              % UPF_SERVICE_MANAGER_EVERY)
@@ -333,6 +556,7 @@ def main():
                              % UPF_SERVICE_ADDRESS)
 
     parser.add_argument("-p", "--us_port", dest="us_port",
+                        type=int,
                         default=UPF_SERVICE_PORT,
                         help="UPF Service port; default=%s"
                              % UPF_SERVICE_PORT)
@@ -348,6 +572,7 @@ def main():
                              % UPF_SERVICE_UE_SUBNET)
 
     parser.add_argument("-e", "--us_every", dest="us_every",
+                        type=int,
                         default=UPF_SERVICE_EVERY,
                         help="UPF Service keepalive period; default=%s"
                              % UPF_SERVICE_EVERY)
@@ -366,21 +591,12 @@ def main():
                             args.us_element, args.us_ue_subnet, args.us_every,
                             args.logdir)
 
-    agent.on_open = on_open
-    agent.on_message = on_message
-    agent.on_close = on_close
-
-    stop = False
-
-    while not stop:
-        try:
-            logging.info("Trying to connect to manager %s", url)
-            agent.run_forever()
-            logging.info("Unable to connect, retrying in %us", agent.usm_every)
-            time.sleep(agent.usm_every)
-        except KeyboardInterrupt:
-            agent.stop()
-            stop = True
+    try:
+        asyncio.run(connect(agent))
+    except KeyboardInterrupt:
+        # asyncio.run() has already cancelled the tasks, closing the
+        # web-socket, and the loop is gone, so there is nothing to stop
+        pass
 
 
 if __name__ == "__main__":
@@ -19,72 +19,306 @@
 """UPF Service Agent Click Handler."""
 
 import socket
+import threading
 import re
 
+from contextlib import contextmanager
+from functools import lru_cache
 
-def write_handler(host, port, element, handler, value):
-    """Write to a click handler."""
 
-    sock = socket.socket()
-    sock.connect((host, port))
+RECV_BUFSIZE = 65536
+BUSY_POLL_USECS = 50
 
-    f_hand = sock.makefile()
-    line = f_hand.readline()
+_BANNER = b"Click::ControlSocket/1.3\r\n"
+_RESP_RE = re.compile(rb'(\d{3}) ([^\r\n]*)')
 
-    if line != "Click::ControlSocket/1.3\n":
-        raise ValueError("Unexpected reply: %s" % line)
 
-    cmd = "write %s.%s %s\n" % (element, handler, value)
-    sock.send(cmd.encode("utf-8"))
+@lru_cache(maxsize=256)
+def _command(verb, element, handler):
+    """Return the encoded command prefix for an element handler."""
 
-    line = f_hand.readline()
+    return b"%s %s.%s" % (verb, element.encode('ascii'),
+                          handler.encode('ascii'))
 
-    regexp = '([0-9]{3}) (.*)'
-    match = re.match(regexp, line)
 
-    while not match:
-        line = f_hand.readline()
-        match = re.match(regexp, line)
+def _setsockopt(sock, level, name, value):
+    """Set an optional socket option, ignoring unsupported ones."""
 
-    groups = match.groups()
+    if name is None:
+        return
 
-    return (int(groups[0]), groups[1])
+    try:
+        sock.setsockopt(level, name, value)
+    except OSError:
+        pass
 
 
-def read_handler(host, port, element, handler):
-    """Read a click handler."""
+class ClickConn:
+    """A persistent connection to a Click ControlSocket.
+
+    The control socket is a line protocol, so a single connection can serve
+    any number of commands. Commands are serialized by the lock.
+    """
+
+    def __init__(self, host, port):
+
+        self.host = host
+        self.port = port
+        self.sock = None
+        self.lock = threading.Lock()
+
+        self._buf = bytearray(RECV_BUFSIZE)
+        self._start = 0
+        self._end = 0
+
+    def _connect(self):
+        """Connect and check the ControlSocket banner."""
+
+        sock = socket.create_connection((self.host, self.port))
+
+        # commands and replies are short, do not let Nagle or interrupt
+        # coalescing add latency to them; SO_BUSY_POLL needs kernel support
+        # (and CAP_NET_ADMIN), so it is best effort
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        _setsockopt(sock, socket.SOL_SOCKET,
+                    getattr(socket, "SO_BUSY_POLL", None), BUSY_POLL_USECS)
+
+        # the banner is only sent once, on connection
+        try:
+            line = sock.recv(len(_BANNER), socket.MSG_WAITALL)
+        except OSError:
+            sock.close()
+            raise
+
+        if line != _BANNER:
+            sock.close()
+            raise ValueError("Unexpected reply: %s" % line)
+
+        self.sock = sock
+        self._start = 0
+        self._end = 0
+
+    def close(self):
+        """Close the connection."""
+
+        if self.sock:
+            self.sock.close()
+
+        self.sock = None
+
+    def _is_stale(self):
+        """Return True if Click closed or reset the idle connection."""
+
+        try:
+            data = self.sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True
+
+        return not data
+
+    @contextmanager
+    def _session(self):
+        """Run a command under the lock, closing the connection on failure.
+
+        Writes are not idempotent: a command which failed may have been
+        applied, so it is never sent again. Instead, a stale connection is
+        replaced before the command is sent. Any failure may leave part of
+        a reply unread, so the connection is closed whatever the error.
+        """
+
+        with self.lock:
+
+            if self.sock and self._is_stale():
+                self.close()
+
+            if not self.sock:
+                self._connect()
+
+            try:
+                yield
+            except BaseException:
+                self.close()
+                raise
+
+    def _recv(self, length=1):
+        """Receive once, making room for length pending bytes first."""
+
+        pending = self._end - self._start
+
+        if not pending:
+            self._start = self._end = 0
+
+        size = max(length, pending + 1)
+
+        if len(self._buf) - self._start < size:
+            self._buf[:pending] = self._buf[self._start:self._end]
+            self._start = 0
+            self._end = pending
+            if len(self._buf) < size:
+                self._buf.extend(bytes(size - len(self._buf)))
+
+        with memoryview(self._buf) as view:
+            nbytes = self.sock.recv_into(view[self._end:])
+
+        if not nbytes:
+            raise ConnectionError("Connection closed by Click")
+
+        self._end += nbytes
+
+    def _recv_until(self, needle):
+        """Receive until needle is buffered and return its offset."""
+
+        pos = self._buf.find(needle, self._start, self._end)
+
+        while pos < 0:
+            offset = max(self._end - self._start - len(needle) + 1, 0)
+            self._recv()
+            pos = self._buf.find(needle, self._start + offset, self._end)
+
+        return pos
+
+    def _recv_exact(self, length):
+        """Receive until at least length bytes are buffered."""
+
+        while self._end - self._start < length:
+            self._recv(length)
+
+    def _read_status(self):
+
+        eol = self._recv_until(b"\n")
+        match = _RESP_RE.match(self._buf, self._start, eol)
+        self._start = eol + 1
+
+        while not match:
+            eol = self._recv_until(b"\n")
+            match = _RESP_RE.match(self._buf, self._start, eol)
+            self._start = eol + 1
 
-    sock = socket.socket()
-    sock.connect((host, port))
+        return (int(match.group(1)), match.group(2).decode('ascii', 'replace'))
 
-    f_hand = sock.makefile()
-    line = f_hand.readline()
+    def write(self, element, handler, value):
+        """Write to a click handler."""
 
-    if line != "Click::ControlSocket/1.3\n":
-        raise ValueError("Unexpected reply: %s" % line)
+        with self._session():
 
-    cmd = "read %s.%s\n" % (element, handler)
-    sock.send(cmd.encode("utf-8"))
+            self.sock.sendall(_command(b"write", element, handler) + b" " +
+                              str(value).encode('ascii') + b"\n")
 
-    line = f_hand.readline()
+            return self._read_status()
 
-    regexp = '([0-9]{3}) (.*)'
-    match = re.match(regexp, line)
+    def batch_write(self, writes):
+        """Write a list of (element, handler, value) click handlers.
 
-    while not match:
-        line = f_hand.readline()
-        match = re.match(regexp, line)
+        The commands are pipelined in a single send and the replies are
+        returned in the same order.
+        """
 
-    groups = match.groups()
+        with self._session():
 
-    if int(groups[0]) == 200:
+            self.sock.sendall(b"".join(_command(b"write", element, handler) +
+                                       b" " + str(value).encode('ascii') +
+                                       b"\n"
+                                       for element, handler, value in writes))
+
+            return [self._read_status() for _ in writes]
+
+    def _read_reply(self):
+        """Read the reply to a read command."""
+
+        status, line = self._read_status()
+
+        if status == 200:
+
+            eol = self._recv_until(b"\n")
+            line = bytes(self._buf[self._start:eol])
+            header = line.split()
+            self._start = eol + 1
+
+            if len(header) != 2 or header[0] != b"DATA" or \
+                    not header[1].isdigit():
+                raise ValueError("Unexpected reply: %s" % line)
+
+            length = int(header[1])
+            self._recv_exact(length)
+
+            with memoryview(self._buf) as view:
+                data = str(view[self._start:self._start + length], "utf-8")
+
+            self._start += length
+
+            return (status, data)
+
+        return (status, line)
+
+    def read(self, element, handler):
+        """Read a click handler."""
+
+        with self._session():
+
+            self.sock.sendall(_command(b"read", element, handler) + b"\n")
+
+            return self._read_reply()
+
+    def batch_read(self, handlers):
+        """Read a list of (element, handler) click handlers.
+
+        The commands are pipelined in a single send and the replies are
+        returned in the same order.
+        """
+
+        with self._session():
+
+            self.sock.sendall(b"".join(_command(b"read", element, handler) +
+                                       b"\n" for element, handler in handlers))
+
+            return [self._read_reply() for _ in handlers]
+
+
+_conns = dict()
+_conns_lock = threading.Lock()
+
+
+def _get_conn(host, port):
+    """Return the cached connection to host:port, creating it if needed."""
+
+    with _conns_lock:
+
+        conn = _conns.get((host, port))
+
+        if not conn:
+            conn = ClickConn(host, port)
+            _conns[(host, port)] = conn
+
+        return conn
+
+
+def _call(host, port, method, *args):
+    """Run method on the cached connection, reconnecting if needed."""
+
+    return method(_get_conn(host, port), *args)
+
+
+def write_handler(host, port, element, handler, value):
+    """Write to a click handler."""
+
+    return _call(host, port, ClickConn.write, element, handler, value)
+
+
+def batch_write_handler(host, port, writes):
+    """Write a list of (element, handler, value) click handlers at once."""
+
+    return _call(host, port, ClickConn.batch_write, writes)
+
+
+def read_handler(host, port, element, handler):
+    """Read a click handler."""
 
-        line = f_hand.readline()
-        res = line.split(" ")
+    return _call(host, port, ClickConn.read, element, handler)
 
-        length = int(res[1])
-        data = f_hand.read(length)
 
-        return (int(groups[0]), data)
+def batch_read_handler(host, port, handlers):
+    """Read a list of (element, handler) click handlers at once."""
 
-    return (int(groups[0]), line)
+    return _call(host, port, ClickConn.batch_read, handlers)
@@ -18,90 +18,182 @@
 
 """UPF Service Agent Matchmap Handler."""
 
+import asyncio
 import logging
-import time
+
+from dataclasses import dataclass
+from dataclasses import fields
+from functools import lru_cache
+from functools import partial
 
 from iptc import Chain
 from iptc import Match as IPT_Match
 from iptc import Rule
 from iptc import Table
 
+from upfserviceagent.handlers.click import batch_write_handler
 from upfserviceagent.handlers.click import write_handler
 
 
+logger = logging.getLogger(__name__)
+
+CLICK_UPF_MIN_DELAY = 0.05
+CLICK_UPF_MAX_DELAY = 5.0
+
+# the port match module of each IP protocol number, None if unsupported
+_PROT_PORT_SUPP = tuple({6: "tcp", 17: "udp", 132: "sctp"}.get(proto)
+                        for proto in range(256))
+
+
+@lru_cache(maxsize=256)
+def _match_template(ip_proto_num, dst_port):
+    """Return the (module name, dport) of a destination port match.
+
+    Raise KeyError if ports are not supported for ip_proto_num.
+    """
+
+    name = None
+    if 0 <= ip_proto_num < len(_PROT_PORT_SUPP):
+        name = _PROT_PORT_SUPP[ip_proto_num]
+
+    if name is None:
+        raise KeyError(ip_proto_num)
+
+    return (name, str(dst_port))
+
+
+@dataclass(slots=True)
+class Match:
+    """A traffic match and its (optional) destination rewrite."""
+
+    index: int
+    ip_proto_num: int
+    dst_ip: str
+    netmask: int
+    dst_port: int
+    new_dst_ip: str
+    new_dst_port: int
+
+    @classmethod
+    def from_dict(cls, match):
+        """Build a Match from a message dict, KeyError on missing fields."""
+
+        return cls(**{field.name: match[field.name] for field in fields(cls)})
+
+
 class MatchMap:
 
     def __init__(self, ue_subnet, **click_config):
 
         self.ue_subnet = ue_subnet
         self.click_config = click_config
-        self._stop = False
-
-        self._prot_port_supp = {6: "tcp", 17: "udp", 132: "sctp"}
+        self._stop_event = asyncio.Event()
 
         self.nat_table = None
         self.upf_chain = None
 
+        # the matches of the rules in the UPF chain, in chain order; the
+        # iptc rules are only built when they are inserted or deleted
+        self._matches = list()
+
         self.uuid_index_map = dict()
 
-    def start(self):
+        # the applied matches by uuid, so that re-applies are no-ops
+        self._active = dict()
+
+    async def start(self, executor=None):
+        """Wait for Click UPF to start, then init the netfilter rules.
+
+        The blocking Click and netfilter calls run in executor (the loop's
+        default executor if None).
+        """
+
+        loop = asyncio.get_running_loop()
 
-        self._init_click_upf()
-        self._init_netfilter()
+        await self._init_click_upf(executor)
+
+        if not self._stop_event.is_set():
+            await loop.run_in_executor(executor, self._init_netfilter)
 
     def stop(self):
 
-        self._stop = True
+        self._stop_event.set()
+
+    async def _init_click_upf(self, executor):
 
-    def _init_click_upf(self):
+        loop = asyncio.get_running_loop()
+        clear = partial(write_handler, **self.click_config,
+                        handler="matchmapclear", value="0")
+        delay = CLICK_UPF_MIN_DELAY
 
-        while not self._stop:
+        while not self._stop_event.is_set():
             try:
-                write_handler(**self.click_config,
-                              handler="matchmapclear",
-                              value="0")
+                await loop.run_in_executor(executor, clear)
                 break
-            except:
-                logging.info("Waiting for Click UPF to start...")
-                time.sleep(5)
+            except (OSError, ValueError) as ex:
+                logger.info("Waiting for Click UPF to start (%s: %s)...",
+                            type(ex).__name__, ex)
+                try:
+                    await asyncio.wait_for(self._stop_event.wait(), delay)
+                    break
+                except asyncio.TimeoutError:
+                    delay = min(delay * 2, CLICK_UPF_MAX_DELAY)
 
     def _init_netfilter(self):
+        """Hook the UPF chain to PREROUTING for the UE subnet, emptied.
+
+        The changes are made on the cached table and committed to the
+        kernel at once, rather than once per operation.
+        """
 
         self.nat_table = Table(Table.NAT)
-        prerouting_chain = Chain(self.nat_table, "PREROUTING")
+        self.nat_table.autocommit = False
+
+        try:
+            prerouting_chain = Chain(self.nat_table, "PREROUTING")
 
-        for rule in prerouting_chain.rules:
-            if rule.target.name == "UPF":
+            upf_rules = [rule for rule in prerouting_chain.rules
+                         if rule.target.name == "UPF"]
+            for rule in upf_rules:
                 prerouting_chain.delete_rule(rule)
 
-        self.upf_chain = Chain(self.nat_table, "UPF")
-        if self.upf_chain in self.nat_table.chains:
-            self.upf_chain.flush()
-        else:
-            self.nat_table.create_chain(self.upf_chain)
+            self.upf_chain = Chain(self.nat_table, "UPF")
+            if self.nat_table.is_chain(self.upf_chain):
+                self.upf_chain.flush()
+            else:
+                self.nat_table.create_chain(self.upf_chain)
 
-        self.nat_table.refresh()
+            upf_rule = Rule()
+            upf_rule.src = self.ue_subnet
+            upf_rule.create_target("UPF")
+            prerouting_chain.insert_rule(upf_rule)
 
-        upf_rule = Rule()
-        upf_rule.src = self.ue_subnet
-        upf_rule.create_target("UPF")
-        prerouting_chain.insert_rule(upf_rule)
+            self.nat_table.commit()
+        finally:
+            # drops the pending changes if the commit did not happen
+            self.nat_table.refresh()
+            self.nat_table.autocommit = True
 
-        self.nat_table.refresh()
-        self.upf_chain.flush()
+        self._matches = list()
 
     def add_matchmap(self, match, match_uuid):
+        """Add a match, in the same order as add_matchmap_batch.
+
+        The uuid is only recorded once both Click and netfilter are updated,
+        so a failed add can be retried with the same uuid.
+        """
+
+        if self._active.get(match_uuid) == match:
+            logger.debug("Matchmap %s already applied", match_uuid)
+            return
 
         if match_uuid in self.uuid_index_map:
             raise ValueError("Duplicate matchmap uuid")
 
-        self.uuid_index_map[match_uuid] = match["index"]
+        # unsupported protocols raise here, before Click is touched
+        rule = self._get_rule(match)
 
-        upf_service_match = "%s,%s-%s/%s-%s" % (match["index"],
-                                                match["ip_proto_num"],
-                                                match["dst_ip"],
-                                                match["netmask"],
-                                                match["dst_port"])
+        upf_service_match = self._get_upf_service_match(match)
         status, response = write_handler(**self.click_config,
                                          handler="matchmapinsert",
                                          value=upf_service_match)
@@ -109,47 +201,149 @@ class MatchMap:
         if status != 200:
             raise Exception(response)
 
-        if match["new_dst_ip"]:
-            self._add_rewrite_rule(match)
-        else:
-            self._add_dummy_rule(match)
+        try:
+            self._add_rule(match, rule)
+        except Exception:
+            self._delete_click_inserts([match])
+            raise
+
+        self.uuid_index_map[match_uuid] = match.index
+        self._active[match_uuid] = match
+
+    def add_matchmap_batch(self, matches):
+        """Add a list of (match, match_uuid) at once.
+
+        The Click inserts are pipelined on a single connection and the
+        netfilter rules are committed to the kernel once, at the end.
+        Matches which are already applied are skipped.
 
-    def _add_rewrite_rule(self, match):
+        The rules are built before Click is written and the uuids are only
+        recorded once both Click and netfilter are updated: on failure, the
+        Click inserts which succeeded are deleted again.
+        """
+
+        matches = [(match, match_uuid) for match, match_uuid in matches
+                   if self._active.get(match_uuid) != match]
+
+        if not matches:
+            return
+
+        uuids = [match_uuid for _, match_uuid in matches]
+
+        if len(set(uuids)) != len(uuids) or \
+                any(match_uuid in self.uuid_index_map for match_uuid in uuids):
+            raise ValueError("Duplicate matchmap uuid")
+
+        # unsupported protocols raise here, before Click is touched
+        rules = [self._get_rule(match) for match, _ in matches]
+
+        writes = [(self.click_config["element"], "matchmapinsert",
+                   self._get_upf_service_match(match))
+                  for match, _ in matches]
+        results = batch_write_handler(self.click_config["host"],
+                                      self.click_config["port"], writes)
+
+        inserted = [match for (match, _), (status, _) in zip(matches, results)
+                    if status == 200]
+
+        for status, response in results:
+            if status != 200:
+                self._delete_click_inserts(inserted)
+                raise Exception(response)
+
+        # the rules go through libiptc, on the same (legacy) x_tables
+        # table as the UPF chain, with a single commit
+        self.nat_table.autocommit = False
+
+        try:
+            for (match, _), rule in zip(matches, rules):
+                logger.debug("Inserting new rule: %s at index: %s",
+                             rule, match.index)
+                self.upf_chain.insert_rule(rule, match.index)
+            self.nat_table.commit()
+        except Exception:
+            self._delete_click_inserts(inserted)
+            raise
+        finally:
+            self.nat_table.refresh()
+            self.nat_table.autocommit = True
+
+        for match, match_uuid in matches:
+            self._matches.insert(match.index, match)
+            self.uuid_index_map[match_uuid] = match.index
+            self._active[match_uuid] = match
+
+    def _delete_click_inserts(self, matches):
+        """Undo the Click inserts of matches, the latest first."""
+
+        writes = [(self.click_config["element"], "matchmapdelete",
+                   match.index)
+                  for match in reversed(matches)]
+
+        if not writes:
+            return
+
+        results = batch_write_handler(self.click_config["host"],
+                                      self.click_config["port"], writes)
+
+        for status, response in results:
+            if status != 200:
+                logger.info("Cannot roll back matchmap insert: %s", response)
+
+    def _get_upf_service_match(self, match):
+
+        return (f"{match.index},{match.ip_proto_num}-"
+                f"{match.dst_ip}/{match.netmask}-{match.dst_port}")
+
+    def _add_rule(self, match, rule):
+
+        logger.debug("Inserting new rule: %s at index: %s",
+                     rule, match.index)
+        self.upf_chain.insert_rule(rule, match.index)
+        self._matches.insert(match.index, match)
+
+    def _get_rule(self, match):
+
+        if match.new_dst_ip:
+            return self._get_rewrite_rule(match)
+
+        return self._get_dummy_rule(match)
+
+    def _get_destination(self, match):
+
+        if match.new_dst_port == 0:
+            return match.new_dst_ip
+
+        return f"{match.new_dst_ip}:{match.new_dst_port}"
+
+    def _get_rewrite_rule(self, match):
 
         rule = self._get_base_rule(match)
 
         rule.create_target("DNAT")
-        rule.target.to_destination = match["new_dst_ip"]
+        rule.target.to_destination = self._get_destination(match)
 
-        if match["new_dst_port"] != 0:
-            rule.target.to_destination += ":%s" % match["new_dst_port"]
-
-        logging.debug("Inserting new rule: %s at index: %s"
-                      % (rule, match["index"]))
-        self.upf_chain.insert_rule(rule, match["index"])
-        self.nat_table.refresh()
+        return rule
 
-    def _add_dummy_rule(self, match):
+    def _get_dummy_rule(self, match):
 
         rule = self._get_base_rule(match)
 
         rule.create_target("ACCEPT")
 
-        logging.debug("Inserting new rule: %s at index: %s"
-                      % (rule, match["index"]))
-        self.upf_chain.insert_rule(rule, match["index"])
-        self.nat_table.refresh()
+        return rule
 
     def _get_base_rule(self, match):
 
         rule = Rule()
-        rule.protocol = match["ip_proto_num"]
-        rule.dst = "%s/%s" % (match["dst_ip"], match["netmask"])
-
-        if match["dst_port"] != 0:
-            ipt_match = IPT_Match(rule,
-                                  self._prot_port_supp[match["ip_proto_num"]])
-            ipt_match.dport = str(match["dst_port"])
+        rule.protocol = match.ip_proto_num
+        rule.dst = f"{match.dst_ip}/{match.netmask}"
+
+        if match.dst_port != 0:
+            name, dport = _match_template(match.ip_proto_num,
+                                          match.dst_port)
+            ipt_match = IPT_Match(rule, name)
+            ipt_match.dport = dport
             rule.add_match(ipt_match)
 
         return rule
@@ -160,13 +354,18 @@ class MatchMap:
         if match_uuid:
             match_index = self.uuid_index_map[match_uuid]
             handler_name = "matchmapdelete"
-            self.upf_chain.delete_rule(self.upf_chain.rules[match_index])
+            rule = self._get_rule(self._matches[match_index])
+            self.upf_chain.delete_rule(rule)
+            del self._matches[match_index]
             del self.uuid_index_map[match_uuid]
+            self._active.pop(match_uuid, None)
         else:
             self.uuid_index_map = dict()
+            self._active = dict()
             match_index = -1
             handler_name = "matchmapclear"
             self.upf_chain.flush()
+            self._matches = list()
 
         status, response = write_handler(**self.click_config,
                                          handler=handler_name,
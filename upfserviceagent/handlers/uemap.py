@@ -18,22 +18,174 @@
 
 """UPF Service Agent UEmap Handler."""
 
+import logging
+import sys
+import threading
+import time
+
+from collections import namedtuple
+from functools import wraps
+from types import MappingProxyType
+
 from upfserviceagent.handlers.click import read_handler
 
 
-def get_uemap(**config):
+logger = logging.getLogger(__name__)
+
+UEMAP_CACHE_TTL = 1.0
+
+UEEntry = namedtuple("UEEntry",
+                     "ue_ip enb_ip teid_downlink epc_ip teid_uplink")
+
+# the last (reply, version, UE map) read, by (host, port, element)
+_uemaps = dict()
+_uemaps_lock = threading.Lock()
+
+
+def _log_malformed(lines):
+
+    for line in lines:
+        logger.info("Skipping malformed uemap line: %r", line)
+
+
+def _parse_uemap(response):
+    """Parse a uemap reply into a dict of UEEntry named tuples by ue_ip.
+
+    Lines without one field per UEEntry field are logged and skipped.
+    """
+
+    intern = sys.intern
+    make = UEEntry._make
+    nfields = len(UEEntry._fields)
+    uemap = dict()
+    malformed = list()
+
+    # lines end in "\n", with an optional "\r", as in the C parser; UE
+    # addresses are interned: they repeat across polls and are used as
+    # keys both here and by the callers
+    for line in response.split('\n'):
+        line = line.rstrip('\r')
+        if line:
+            row = line.split(',')
+            if len(row) != nfields:
+                malformed.append(line)
+                continue
+            row[0] = intern(row[0])
+            uemap[row[0]] = make(row)
+
+    _log_malformed(malformed)
+
+    return uemap
+
+
+try:
+    from upfserviceagent._uemap_parser import parse as _parse_ext
+except ImportError:
+    parse_uemap = _parse_uemap
+else:
+    def parse_uemap(response):
+        """Parse a uemap reply using the C extension."""
+
+        uemap, malformed = _parse_ext(response, UEEntry)
+        _log_malformed(malformed)
+
+        return uemap
+
+
+def ttl_cache(seconds, key):
+    """Cache the result of a function of keyword arguments for seconds.
+
+    The cached value is shared by the callers, so it must be immutable.
+    The wrapper's cache_clear() drops all the cached entries.
+    """
+
+    def decorator(func):
+
+        cache = dict()
+        lock = threading.Lock()
+
+        @wraps(func)
+        def wrapper(**kwargs):
+
+            cache_key = key(**kwargs)
+            now = time.monotonic()
+
+            with lock:
+                entry = cache.get(cache_key)
+
+            if entry and entry[0] > now:
+                return entry[1]
+
+            value = func(**kwargs)
+
+            with lock:
+                cache[cache_key] = (now + seconds, value)
+
+            return value
+
+        def cache_clear():
+
+            with lock:
+                cache.clear()
+
+        wrapper.cache_clear = cache_clear
+
+        return wrapper
+
+    return decorator
+
+
+def invalidate_uemap_cache():
+    """Make the next get_uemap() call read the UE map from Click."""
+
+    _read_uemap.cache_clear()
+
+
+def _uemap_key(**config):
+
+    return (config["host"], config["port"], config["element"])
+
+
+@ttl_cache(seconds=UEMAP_CACHE_TTL, key=_uemap_key)
+def _read_uemap(**config):
+    """Return the (version, UE map), reparsed only if the reply changed."""
 
     status, response = read_handler(**config, handler="uemap")
 
     if status != 200:
         raise Exception(response)
 
-    fields = ["ue_ip", "enb_ip", "teid_downlink", "epc_ip", "teid_uplink"]
-    uemap = dict()
+    key = _uemap_key(**config)
 
-    for ue_entry in response.split('\n'):
-        if ue_entry != "":
-            ue_dict = dict(zip(fields, ue_entry.split(',')))
-            uemap[ue_dict["ue_ip"]] = ue_dict
+    with _uemaps_lock:
 
-    return uemap
+        last = _uemaps.get(key)
+
+        if last and last[0] == response:
+            return last[1:]
+
+        version = last[1] + 1 if last else 0
+        uemap = MappingProxyType(parse_uemap(response))
+        _uemaps[key] = (response, version, uemap)
+
+    return (version, uemap)
+
+
+def get_uemap(**config):
+    """Return the UE map, as a read-only mapping of UEEntry by ue_ip.
+
+    The same mapping is shared by all the callers until the UE map changes.
+    """
+
+    return _read_uemap(**config)[1]
+
+
+def get_uemap_if_changed(version, **config):
+    """Return (version, UE map), the UE map None if version is current."""
+
+    current, uemap = _read_uemap(**config)
+
+    if current == version:
+        return (current, None)
+
+    return (current, uemap)